@@ -4,8 +4,9 @@ Requirements:
     Python 3.6
     JellyPy
     GeL Report Models (v6 or higher)
+    orjson (optional - speeds up parsing of CIP-API responses)
 
-usage: get_tiered_variants.py [-h] -o OUTPUT_FILE
+usage: get_tiered_variants.py [-h] -o OUTPUT_FILE [-w WORKERS]
 
 Pulls Guys 100k cases from CIP-API and outputs file showing which are negative
 negatives
@@ -14,15 +15,34 @@ optional arguments:
   -h, --help            show this help message and exit
   -o OUTPUT_FILE, --output_file OUTPUT_FILE
                         Output file (tsv)
+  -w WORKERS, --workers WORKERS
+                        Number of cases to fetch from CIP-API concurrently
+                        (default: 32)
 """
 
 import argparse
 import distutils.version
+import functools
+import sys
 # Import JellyPy
 import pyCIPAPI.interpretation_requests
-# Import GeLReportModels v6.0
-import protocols.reports_6_0_0
 import collections
+import concurrent.futures
+import itertools
+import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# GeL only report SVs and STRs since GeL tiering version 1.0.14
+MIN_TIERING = distutils.version.StrictVersion('1.0.14')
+# Rank of each tier used to rank small variants. Any other tier (or no tier) is given a rank of 4
+TIER_RANK = {'TIER1': 1, 'TIER2': 2, 'TIER3': 3}
+# Site codes used for Guys cases in CIP-API
+GUYS_SITES = frozenset({'RJ1', 'RJ101', 'GSTT'})
+# CIPs that aren't checked for CIP candidate variants
+EXCLUDED_CIPS = frozenset({'genomics_england_tiering', 'exomiser'})
 
 
 def process_arguments():
@@ -33,250 +53,279 @@ def process_arguments():
     parser = argparse.ArgumentParser(description='Pulls Guys 100k cases from CIP-API and outputs file showing which are negative negatives')
     # Define the arguments that will be taken.
     parser.add_argument('-o', '--output_file', required=True, help='Output file (tsv)')
+    parser.add_argument('-w', '--workers', type=int, default=32, help='Number of cases to fetch from CIP-API concurrently (default: 32)')
     # Return the arguments
     return parser.parse_args()
 
 
+@functools.lru_cache(maxsize=64)
+def _parse_ver(version):
+    """
+    Parses a software version string. Only a handful of GeL tiering versions exist, so results are cached.
+    """
+    return distutils.version.StrictVersion(version)
+
+
+def use_orjson_for_responses():
+    """
+    Parses CIP-API responses using orjson, which is considerably faster than the standard library json module.
+    pyCIPAPI parses responses by calling the json() method of requests Response objects, so this method is replaced.
+    Does nothing if orjson is not installed.
+    """
+    if orjson is None:
+        return
+    standard_json = requests.models.Response.json
+
+    def orjson_json(self, **kwargs):
+        # orjson doesn't accept any of the json module keyword arguments, so use the standard method if these are supplied
+        if kwargs:
+            return standard_json(self, **kwargs)
+        return orjson.loads(self.content)
+    requests.models.Response.json = orjson_json
+
+
 def group_vars_by_cip(interpreted_genomes_json):
     """
     Groups variants by CIP provider
     Args:
         interpreted_genomes_json: interpreted genome JSON from CIP API
     Returns:
-        Nested dictionary of variants grouped by CIP and cip version. {key = CIP value = {key = cip_version, value = list_of_variants}}
+        Dictionary of variants from the latest interpreted genome for each CIP.
+        {key = CIP, value = (max_cip_version, list_of_variant_JSONs, interpreted_genome_data)}
     """
     # Note this does not pull out CNVs/SVs
     vars_by_cip = {}
+    # Record the cip versions seen for each CIP
+    cip_versions = collections.defaultdict(set)
     # possible values for cip at time of writing:
     # omicia, congenica, nextcode, genomics_england_tiering, illumina, exomiser
     # There will be a separate interepreted genome for each cip used
     for ig in interpreted_genomes_json:
-        # Convert the interpreted genome JSON into InterpretedGenome object from GeL Report Models v6.0
-        ig_obj = protocols.reports_6_0_0.InterpretedGenome.fromJsonDict(ig['interpreted_genome_data'])
+        # Only a few fields of the interpreted genome are needed, so read these straight from the JSON rather than
+        # converting the whole thing into an InterpretedGenome object from GeL Report Models v6.0
+        ig_data = ig['interpreted_genome_data']
         # cip provider stored in the interpretationService field.
         # Store the list of reported variants for that cip
-        cip = ig_obj.interpretationService.lower()
+        cip = ig_data['interpretationService'].lower()
         cip_version = int(ig['cip_version'])
-        # If cip not already in dictionary, add it in with an empty dictionary as value
-        vars_by_cip[cip] = vars_by_cip.setdefault(cip, {})
         # If CIP is present multiple times each should have it's own version number
         # However do a quick test to make sure this is true and error out if not
-        if cip_version in vars_by_cip[cip]:
-            sys.exit(f"Multiple interpreted genomes with version number '{cip_version}' for interpretation service '{cip}'")
-        # If there are variants, add the variant list for that cip/version to dictionary.
-        if ig_obj.variants:
-            vars_by_cip[cip][cip_version] = ig_obj.variants
+        if cip_version in cip_versions[cip]:
+            raise ValueError(f"Multiple interpreted genomes with version number '{cip_version}' for interpretation service '{cip}'")
+        cip_versions[cip].add(cip_version)
+        # There may be multiple interpreted genomes for a single CIP, so only keep the one with the highest cip_version number
         # If there aren't any variants just store empty list
-        else:
-            vars_by_cip[cip][cip_version] = []
+        # The interpreted genome data is also kept, so other fields (e.g. SVs, STRs) can be checked without fetching it again
+        if cip not in vars_by_cip or cip_version > vars_by_cip[cip][0]:
+            vars_by_cip[cip] = (cip_version, ig_data.get('variants') or [], ig_data)
     return vars_by_cip
 
 
-def group_vars_by_tier(variants_json):
+def top_tier_rank(tiers):
     """
-    Groups variants according to their GeL tier
+    Finds the highest ranked tier from the tiers of a variant's report events
     Args:
-        variants_json: list of GeL report model v6 variant objects
+        tiers: iterable of report event tiers (e.g. 'TIER1', 'TIERA')
     Returns:
-        Dictionary of variants grouped by tier {key = tier, value = list of variant objects}
+        1, 2 or 3 for the highest ranked of tiers 1-3 (the lowest number ranks highest), or 4 if none of the tiers are 1-3
     """
-    # Takes list of variants and groups them by tier (Note this doesn't include SVs/CNVs)
-    tiered_vars = {
-        'TIER1': [],
-        'TIER2': [],
-        'TIER3': [],
-        'OTHER': []
-        }
-    for variant in variants_json:
-        # Log the tier for each report event for a variant
-        tiers = []
-        for reportevent in variant.reportEvents:
-            # Possible values for tier in report model v6 are NONE, TIER1, TIER2, TIER3, TIER4, TIER5, TIERA, TIERB
-            if reportevent.tier.upper() in ('TIER1', 'TIER2', 'TIER3'):
-                # Record the tier number
-                tiers.append(int(reportevent.tier.strip('TIER')))
-            else:
-                # Value of 4 used to represent any other or no tier.
-                tiers.append(4)
-        # The lowest number represents the highest ranked tier for that variant (e.g. tier 1 ranks higher than tier 2)
-        top_rank_tier = min(tiers)
-        # Record the variant in the dictionary based on it's highest ranked tier
-        if top_rank_tier == 4:
-            tiered_vars['OTHER'].append(variant)
-        else:
-            tiered_vars[f'TIER{top_rank_tier}'].append(variant)
-    return tiered_vars
-
-def rare_tierA_SVs(interpreted_genome_json):
+    top_rank = 4
+    for tier in tiers:
+        # Possible values for tier in report model v6 are NONE, TIER1, TIER2, TIER3, TIER4, TIER5, TIERA, TIERB
+        # Value of 4 used to represent any other or no tier.
+        rank = TIER_RANK.get(tier, 4)
+        if rank < top_rank:
+            top_rank = rank
+            # Nothing ranks higher than tier 1, so no need to look at the remaining report events
+            if top_rank == 1:
+                break
+    return top_rank
+
+
+def is_non_tier3(variant_json):
     """
-    Returns list of tier A structural variants with population frequency <1% 
+    Checks whether a variant's highest ranked tier is anything other than tier 3.
     Args:
-        interpreted_genomes_json: interpreted genome JSON from CIP API
+        variant_json: variant JSON from a GeL report model v6 interpreted genome
+    Returns:
+        Boolean: True if variant has a tier 1 or 2 report event, or has no tier 1, 2 or 3 report events
+    """
+    return top_tier_rank(reportevent['tier'] for reportevent in variant_json['reportEvents']) != 3
+
+
+def count_rare_tierA_SVs(interpreted_genome_data):
+    """
+    Counts tier A structural variants with population frequency <1%.
+    Args:
+        interpreted_genome_data: interpreted_genome_data field of an interpreted genome JSON from CIP API
     Returns:
-        List of GeL report model v6 StructuralVariant objects
+        Number of rare tier A structural variants
     """
-    # List to hold rare (<1%) tier A SVs
-    tiera_svs = []
-    ig_obj = protocols.reports_6_0_0.InterpretedGenome.fromJsonDict(interpreted_genome_json['interpreted_genome_data'])
-    if ig_obj.structuralVariants:
+    num_tiera_svs = 0
+    if interpreted_genome_data.get('structuralVariants'):
         # GeL only report SVs since GeL tiering version 1.0.14, so ignore any earlier versions
-        if distutils.version.StrictVersion(ig_obj.softwareVersions["gel-tiering"]) >= distutils.version.StrictVersion('1.0.14'): 
-            for sv in ig_obj.structuralVariants:
-                # Each variant can have multiple report events, each with it's own tier
-                # Only want to add variant to list once, so use flag to prevent it being added multiple times
-                added_tiera_list = False
-                for event in sv.reportEvents:
-                    if event.tier == 'TIERA' and not added_tiera_list:
-                        # Exclude common SVs (>1% allele frequency)
-                        # Note frequencies not reported for sex chromosomes, so all tier A sex chromosome SVs will need investigating.
-                        if sv.variantAttributes.alleleFrequencies:
-                            allele_frequencies = [x.alternateFrequency for x in sv.variantAttributes.alleleFrequencies]                            
-                            if max(allele_frequencies) <= 0.01:
-                                tiera_svs.append(sv)
-                                added_tiera_list = True
-                        # Else if frequencies not reported (e.g. sex chromosomes), can't exclude so add to list
-                        else:
-                            tiera_svs.append(sv)
-                            added_tiera_list = True
-    return tiera_svs
-
-def tiered_STRs(interpreted_genome_json):
+        if _parse_ver(interpreted_genome_data['softwareVersions']['gel-tiering']) >= MIN_TIERING:
+            for sv in interpreted_genome_data['structuralVariants']:
+                if any(event['tier'] == 'TIERA' for event in sv['reportEvents']):
+                    # Exclude common SVs (>1% allele frequency). Frequencies not reported for sex chromosomes, so these are always counted.
+                    allele_frequencies = sv['variantAttributes'].get('alleleFrequencies')
+                    if not allele_frequencies or max(x['alternateFrequency'] for x in allele_frequencies) <= 0.01:
+                        num_tiera_svs += 1
+    return num_tiera_svs
+
+
+def count_tiered_STRs(interpreted_genome_data):
     """
-    Returns list of tiered short tandem repeats (STRs) for a case.
+    Counts tier 1 and 2 short tandem repeats (STRs).
     Repeats in the pathogenic range are reported as Tier 1. Repeats in the intermediate range are reported as Tier 2.
     Repeats in the normal range are not reported.
     Args:
-        interpreted_genomes_json: interpreted genome JSON from CIP API
+        interpreted_genome_data: interpreted_genome_data field of an interpreted genome JSON from CIP API
     Returns:
-        List of GeL report model v6 ShortTandemRepeat objects
+        Number of tiered STRs
     """
-    # List to hold tiered STRs
-    tiered_strs = []
-    ig_obj = protocols.reports_6_0_0.InterpretedGenome.fromJsonDict(interpreted_genome_json['interpreted_genome_data'])
-    if ig_obj.shortTandemRepeats:
+    num_tiered_strs = 0
+    if interpreted_genome_data.get('shortTandemRepeats'):
         # GeL only report STRs since GeL tiering version 1.0.14, so ignore any earlier versions
-        if distutils.version.StrictVersion(ig_obj.softwareVersions["gel-tiering"]) >= distutils.version.StrictVersion('1.0.14'): 
-            for repeat in ig_obj.shortTandemRepeats:
-                # Each variant can have multiple report events, each with it's own tier
-                # Only want to add variant to list once, so use flag to prevent it being added multiple times
-                added_tiered_strs = False
-                for event in repeat.reportEvents:
-                    if event.tier in ('TIER1', 'TIER2') and not added_tiered_strs:
-                        tiered_strs.append(repeat)
-                        added_tiered_strs = True
-    return tiered_strs
-
-
-def is_neg_neg(ir_json, ir_id, ir_version):
+        if _parse_ver(interpreted_genome_data['softwareVersions']['gel-tiering']) >= MIN_TIERING:
+            for repeat in interpreted_genome_data['shortTandemRepeats']:
+                if any(event['tier'] in ('TIER1', 'TIER2') for event in repeat['reportEvents']):
+                    num_tiered_strs += 1
+    return num_tiered_strs
+
+
+def is_neg_neg(ir_json):
     """
     Checks if a case is a negative negative (no variants other than tier 3, no rare tier A CNVs, no case flags (tags))
     Args:
         ir_json: Interpretation request JSON from the CIP-API
-        ir_id: Interpretation request ID
-        ir_version:
-        cips: List of CIPs that should be checked for candidate variants (e.g. 'omicia', 'genomics_england', 'exomiser' etc)
     Returns:
         Boolean: True if negative negative, False if not.
     """
-    # Create a dictionary of variant lists (value) grouped by CIP (key - lowercase)
+    # negneg if no case flags (e.g. UPD), no non-tier3 or cip candidate variants, no rare tier A SV/CNVs and no tiered STRs.
+    # Checks are ordered cheapest first, and return as soon as anything rules the case out.
+    if ir_json['tags']:
+        return False
+    # Create a dictionary of the latest variant lists (value) grouped by CIP (key - lowercase)
     vars_by_cip = group_vars_by_cip(ir_json['interpreted_genome'])
-    # There may be multiple interpreted genomes for a single CIP, so take the one with the highest cip_version number
-    max_version = max(vars_by_cip['genomics_england_tiering'].keys())
-    # Group variants from genomics_england_tiering by tier
-    gel_tiered_vars = group_vars_by_tier(vars_by_cip['genomics_england_tiering'][max_version])
-    # Get latest genomics england tiering interpreted genome
-    ig = pyCIPAPI.interpretation_requests.get_interpreted_genome_for_case(ir_id, ir_version, 'genomics_england_tiering')
-    # Get rare (<1%) tier A SVs
-    rare_tiera_SV_list = rare_tierA_SVs(ig)
-    # Get tier 1/2 STRs
-    tiered_STR_list = tiered_STRs(ig)
-    # negneg if no non-tier3 or cip candidate variants, no rare tier A SV/CNVs, no tiered STRs, and no case flags (e.g. UPD)
-    num_tier1 = len(gel_tiered_vars['TIER1'])
-    num_tier2 = len(gel_tiered_vars['TIER2'])
-    num_other = len(gel_tiered_vars['OTHER'])
-    num_tiera_sv = len(rare_tiera_SV_list)
-    num_tiered_strs = len(tiered_STR_list)
-    num_case_flags = len(ir_json['tags'])
-    # Initialise cip_candidates variable to zero, then loop through cips counting variants
-    cip_candidates = 0
-    for cip in vars_by_cip:
-        if cip not in ['genomics_england_tiering', 'exomiser']:
-            # There may be multiple interpreted genomes for a single CIP, so take the one with the highest cip_version number
-            max_version = max(vars_by_cip[cip].keys())
-            cip_candidates += len(vars_by_cip[cip][max_version])
-    # Return true if it's a negative negative, otherwise return false.
-    if sum((num_tier1, num_tier2, num_other, cip_candidates, num_tiera_sv, num_tiered_strs, num_case_flags)) == 0:
-        return True
-    return False
-
-
-def group_cases():
+    # Check for CIP candidate variants
+    if any(variants for cip, (_, variants, _) in vars_by_cip.items() if cip not in EXCLUDED_CIPS):
+        return False
+    # Check for variants from genomics_england_tiering that aren't tier 3
+    _, gel_variants, gel_ig_data = vars_by_cip['genomics_england_tiering']
+    if any(is_non_tier3(variant) for variant in gel_variants):
+        return False
+    # Check for rare (<1%) tier A SVs and tier 1/2 STRs, using the latest genomics england tiering interpreted genome
+    # already in the interpretation request JSON (so no need to fetch it from CIP-API)
+    if count_rare_tierA_SVs(gel_ig_data) or count_tiered_STRs(gel_ig_data):
+        return False
+    return True
+
+
+def get_cases(status):
     """
-    Groups all Guys cases in CIP-API based on whether they are negative negatives
-    Returns:
-        Dictionary of grouped cases {key = group, value = list of case JSONs from CIP-API}
+    Returns list of rare disease case JSONs from CIP-API with a given last status (e.g. 'sent_to_gmcs')
+    """
+    return pyCIPAPI.interpretation_requests.get_interpretation_request_list(last_status=status, sample_type='raredisease')
+
+
+def get_probands(status):
+    """
+    Returns list of proband IDs for rare disease cases in CIP-API with a given last status.
+    Only the proband IDs are kept, so the rest of each case JSON can be freed straight away.
+    """
+    return [case['proband'] for case in get_cases(status)]
+
+
+def iter_classified_cases(max_workers=32):
+    """
+    Groups all Guys cases in CIP-API based on whether they are negative negatives.
+    Cases are yielded as soon as they have been classified, so results can be written out while later cases are still being fetched.
+    Args:
+        max_workers: Number of cases to fetch from the CIP-API concurrently
+    Yields:
+        Tuple of (group, case JSON from CIP-API)
     """
     # Pull out all cases that are either ready for interpretation or have been reported
-    sent_to_gmcs = pyCIPAPI.interpretation_requests.get_interpretation_request_list(last_status='sent_to_gmcs', sample_type='raredisease')
-    report_generated = pyCIPAPI.interpretation_requests.get_interpretation_request_list(last_status='report_generated', sample_type='raredisease')
-    report_sent = pyCIPAPI.interpretation_requests.get_interpretation_request_list(last_status='report_sent', sample_type='raredisease')
+    # Each status is a separate (paginated) list query, so run them concurrently rather than one after another
+    # Reported cases are only used to count interpretation requests, so only keep their proband IDs
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        sent_to_gmcs_future = executor.submit(get_cases, 'sent_to_gmcs')
+        reported_probands = list(executor.map(get_probands, ('report_generated', 'report_sent')))
+        sent_to_gmcs = sent_to_gmcs_future.result()
     # Count number of times each proband ID occurs and store in dictionary (key = proband ID, value = count), used later to identify cases with multiple interpretation requests.
-    num_requests = collections.Counter([case['proband'] for case in sent_to_gmcs + report_generated + report_sent])
+    num_requests = collections.Counter(itertools.chain((case['proband'] for case in sent_to_gmcs), *reported_probands))
     # Filter cases that are awaiting interpretation to only include Guys cases
-    guys_cases = (case for case in sent_to_gmcs if ('RJ1' in case['sites'] or 'RJ101' in case['sites'] or 'GSTT' in case['sites']))
-    # Cases will be grouped as below.
-    # 'negnegs_one_request' = negneg cases where there are no other ongoing or reported interpretation requests for that patient - can be reported automatically
-    # 'negnegs_multiple_requests' = negneg cases where there are other active or reported interpretation requests for that patient (which may not be negneg)
-    # 'error' = Error encountered when trying to parse the CIP-API data for this case. Some early pilot cases have broken formatting so they end up here.
-    # 'all_other' = Everything else.
-    grouped_cases = {
-        'negnegs_one_request': [],
-        'negnegs_multiple_requests': [],
-        'error': [],
-        'all_other': []
-    }
-    for case in guys_cases:
+    guys_cases = (case for case in sent_to_gmcs if not GUYS_SITES.isdisjoint(case['sites']))
+
+    def process_case(case):
+        """
+        Fetches a single case from the CIP-API and works out which group it belongs to.
+        Cases will be grouped as below.
+        'negnegs_one_request' = negneg cases where there are no other ongoing or reported interpretation requests for that patient - can be reported automatically
+        'negnegs_multiple_requests' = negneg cases where there are other active or reported interpretation requests for that patient (which may not be negneg)
+        'error' = Error encountered when trying to parse the CIP-API data for this case. Some early pilot cases have broken formatting so they end up here.
+        'all_other' = Everything else.
+        Returns:
+            Tuple of (case JSON, group)
+        """
         # Capture interpretation request ID and version
         ir_id = case['interpretation_request_id'].split('-')[0]
         ir_version = case['interpretation_request_id'].split('-')[1]
         participant_id = case['proband']
-        # Return JSON from CIP API, use report models v6
-        try:
-            ir_json = pyCIPAPI.interpretation_requests.get_interpretation_request_json(ir_id, ir_version, reports_v6=True)
-        except:
-            grouped_cases['error'].append(case)
-            continue
-        # Check if case is a negneg
+        # Return JSON from CIP API (use report models v6) and check if case is a negneg
         # Some very old pilot cases have broken formatting causing error here, so catch these with try/except
+        # (JSON decoding errors are subclasses of ValueError)
         try:
-            negneg = is_neg_neg(ir_json, ir_id, ir_version)
-        except:
-            grouped_cases['error'].append(case)
-            continue
+            ir_json = pyCIPAPI.interpretation_requests.get_interpretation_request_json(ir_id, ir_version, reports_v6=True)
+            negneg = is_neg_neg(ir_json)
+        except (KeyError, ValueError, TypeError, AttributeError, requests.RequestException) as err:
+            # Report the reason so that errors can be triaged
+            print(f"{case['interpretation_request_id']}: {type(err).__name__}: {err}", file=sys.stderr)
+            return case, 'error'
         # If it is negneg, check if there's any other active or reported requests for the same participant
         if negneg and num_requests[participant_id] == 1:
-            grouped_cases['negnegs_one_request'].append(case)
+            return case, 'negnegs_one_request'
         elif negneg:
-            grouped_cases['negnegs_multiple_requests'].append(case)
+            return case, 'negnegs_multiple_requests'
         # Else if it's not negneg
-        else:
-            grouped_cases['all_other'].append(case)
-    return grouped_cases
+        return case, 'all_other'
+
+    # Each case needs at least one round-trip to the CIP-API, so fetch several cases at once using a pool of threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_case, case) for case in guys_cases]
+        try:
+            # Pass on each case as soon as it's been classified, whatever order they finish in
+            for future in concurrent.futures.as_completed(futures):
+                case, group = future.result()
+                yield group, case
+        finally:
+            # If stopped early (e.g. by an unexpected error or Ctrl-C), cancel fetches that haven't started,
+            # so the executor only waits for those already running before shutting down
+            for future in futures:
+                future.cancel()
 
 
 def main():
     # Get command line arguments
     args = process_arguments()
     out_file = args.output_file
-    # Open output file and write headers
-    with open(out_file, 'w') as output_file:
+    # Speed up parsing of the (large) interpretation request JSONs returned by CIP-API
+    use_orjson_for_responses()
+    # Open output file (with a large write buffer) and write headers
+    with open(out_file, 'w', buffering=1 << 20) as output_file:
         output_file.write('participant_ID\tCIP_ID\tassembly\tflags\tgroup\n')
-        # Group cases according to variants found in CIP-API
-        grouped_cases = group_cases()
-        # Write the results to a tab separated file
-        for group in grouped_cases.keys():
-            for case in grouped_cases[group]:
-                output_file.write(f"{case['proband']}\t{case['interpretation_request_id']}\t{case['assembly']}\t{';'.join(case['tags'])}\t{group}\n")
+        # Group cases according to variants found in CIP-API, writing the results to a tab separated file as cases are classified
+        # Rows are collected and written in batches to cut down on the number of writes
+        rows = []
+        for group, case in iter_classified_cases(max_workers=args.workers):
+            rows.append('\t'.join(map(str, (case['proband'], case['interpretation_request_id'], case['assembly'], ';'.join(case['tags']), group))))
+            if len(rows) >= 1024:
+                output_file.write('\n'.join(rows) + '\n')
+                rows.clear()
+        # Write any remaining rows
+        if rows:
+            output_file.write('\n'.join(rows) + '\n')
 
 if __name__ == '__main__':
     main()
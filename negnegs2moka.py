@@ -28,6 +28,27 @@ import datetime
 config = ConfigParser()
 config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini"))
 
+# SQL statements. Values are always passed as parameters, so the statement text is the same for every case.
+# Human readable result codes and statuses
+SQL_RESULTCODES = "SELECT ResultCodeID, ResultCode FROM ResultCode"
+SQL_STATUSES = "SELECT StatusID, Status FROM Status"
+SQL_RESULTCODE = "SELECT ResultCode FROM ResultCode WHERE ResultCodeID = ?"
+SQL_STATUS = "SELECT Status FROM Status WHERE StatusID = ?"
+# Join each proband to their patient record and any 100k NGS tests, for a list of participant IDs ({qmarks} = one ? per ID).
+# ProbandCount is used to check there's only one record for the participant in Probands_100k
+SQL_CASE_DETAILS = (
+    "SELECT p.Participant_ID, p.InternalPatientID, p.Referring_Clinician, p.PatientTrustID, "
+    "(SELECT COUNT(*) FROM Probands_100k p2 WHERE p2.Participant_ID = p.Participant_ID) AS ProbandCount, "
+    "pt.s_StatusOverall, n.NGSTestID, n.StatusID, n.IRID, n.GELProbandID, n.ResultCode, n.BookBy, n.Check1ID, n.Check1Date, n.BlockAutomatedReporting "
+    "FROM Probands_100k p "
+    "LEFT JOIN Patients pt ON pt.InternalPatientID = p.InternalPatientID "
+    "LEFT JOIN dbo.NGSTest n ON n.InternalPatientID = p.InternalPatientID AND n.ReferralID = 1199901218 "
+    "WHERE p.Participant_ID IN ({qmarks})"
+    )
+# Set result code and status, with Moka as Checker1
+SQL_UPDATE_NGSTEST = "UPDATE NGSTest SET ResultCode = ?, StatusID = ?, Check1ID = 1201865448, Check1Date = ? WHERE NGSTestID = ?"
+SQL_INSERT_PATIENTLOG = "INSERT INTO PatientLog (InternalPatientID, LogEntry, Date, Login, PCName) VALUES (?, ?, ?, ?, ?)"
+
 def process_arguments():
     """
     Uses argparse module to define and handle command line input arguments and help menu
@@ -89,11 +110,72 @@ class MokaConnector(object):
         self.cnxn = pyodbc.connect(
             f'DRIVER={{ODBC Driver 17 for SQL Server}}; SERVER={config.get("MOKA", "SERVER")}; DATABASE={config.get("MOKA", "DATABASE")}; '
             f'UID={config.get("MOKA", "USER")}; PWD={config.get("MOKA", "PASSWORD")}',
-            autocommit=True
+            autocommit=False
             )
         self.cursor = self.cnxn.cursor()
+        # Values recorded against every update made during this run
+        # The name of the script is used as 'Login' and the server hostname as 'PCName' in the patient log
+        # Drop microseconds: pyodbc's fast_executemany can't bind them to legacy datetime columns such as Check1Date
+        self.run_date = datetime.datetime.now().replace(microsecond=0)
+        self.login = os.path.basename(__file__)
+        self.pcname = socket.gethostname()
+        # Cache the human readable result codes and statuses, so they don't need looking up for every case
+        self.resultcode_names = {row.ResultCodeID: row.ResultCode for row in self.cursor.execute(SQL_RESULTCODES).fetchall()}
+        self.status_names = {row.StatusID: row.Status for row in self.cursor.execute(SQL_STATUSES).fetchall()}
+        # NGSTest updates and patient log entries are collected here and written to Moka in batches by write_pending()
+        self.pending_updates = []
+        self.pending_logs = []
+
+    def get_resultcode_name(self, resultcode):
+        """
+        Get the human readable name for a result code ID. Looked up in Moka if it has been added since the cache was populated.
+        """
+        if resultcode not in self.resultcode_names:
+            self.resultcode_names[resultcode] = self.cursor.execute(SQL_RESULTCODE, resultcode).fetchone().ResultCode
+        return self.resultcode_names[resultcode]
+
+    def get_status_name(self, status):
+        """
+        Get the human readable name for a status ID. Looked up in Moka if it has been added since the cache was populated.
+        """
+        if status not in self.status_names:
+            self.status_names[status] = self.cursor.execute(SQL_STATUS, status).fetchone().Status
+        return self.status_names[status]
+
+    def write_pending(self):
+        """
+        Write all pending NGSTest updates and patient log entries to Moka, using one batched statement for each.
+        All changes are committed in a single transaction, or rolled back if any of them fail.
+        """
+        cursor = self.cnxn.cursor()
+        # Send the parameters for every row in one go, rather than a round-trip per row
+        cursor.fast_executemany = True
+        try:
+            if self.pending_updates:
+                cursor.executemany(SQL_UPDATE_NGSTEST, self.pending_updates)
+            if self.pending_logs:
+                cursor.executemany(SQL_INSERT_PATIENTLOG, self.pending_logs)
+            self.commit()
+        # Don't leave NGSTests half updated if anything fails
+        except pyodbc.Error:
+            self.cnxn.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.pending_updates = []
+        self.pending_logs = []
+
+    def commit(self):
+        """
+        Commit the current transaction
+        """
+        self.cnxn.commit()
 
-    def __del__(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
         self.cnxn.close()
 
 class Case100kMoka(object):
@@ -103,7 +185,6 @@ class Case100kMoka(object):
     def __init__(self, participantID, intrequestID):
         self.participantID = participantID
         self.intrequestID = intrequestID
-        self.proband_100k_rows = []
         self.internalPatientID = None
         self.patient_status = None
         self.clinicianID = None
@@ -111,128 +192,107 @@ class Case100kMoka(object):
         self.ngstests = []
 
 
-    def get_moka_patientIDs(self, cursor):
-        """
-        Get information from Moka related to the proband 
+    @classmethod
+    def hydrate_all(cls, cursor, cases):
         """
-        sql = "SELECT InternalPatientID, Referring_Clinician, PatientTrustID FROM Probands_100k WHERE Participant_ID = '{participantID}'".format(participantID=self.participantID)
-        self.proband_100k_rows = cursor.execute(sql).fetchall()
-        # Only update attributes if a single matching record is found.
-        if len(self.proband_100k_rows) == 1:
-            self.internalPatientID = self.proband_100k_rows[0].InternalPatientID
-            self.clinicianID = self.proband_100k_rows[0].Referring_Clinician
-            self.pru = self.proband_100k_rows[0].PatientTrustID
+        Get proband, patient status and 100k NGS test details from Moka for a list of cases, using a single query
+        (per batch of participant IDs) rather than separate queries for each case.
 
-    def get_patient_status(self, cursor):
-        """
-        Get the patient status from Moka
-        """
-        if self.internalPatientID:
-            sql = "SELECT s_StatusOverall FROM Patients WHERE InternalPatientID = {internalPatientID}".format(internalPatientID=self.internalPatientID)
-            self.patient_status = cursor.execute(sql).fetchone().s_StatusOverall
-
-    def get_moka_ngstests(self, cursor):
-        """
-        Get list of matching 100k NGS test records from Moka
+        Args:
+            cursor: pyodbc cursor for the Moka database
+            cases: list of Case100kMoka objects
         """
-        # Only execute if internal patient ID is known.
-        if self.internalPatientID:
-            sql = "SELECT NGSTestID, StatusID, IRID, GELProbandID, ResultCode, BookBy, Check1ID, Check1Date, BlockAutomatedReporting FROM dbo.NGSTest WHERE InternalPatientID = {internalPatientID} AND ReferralID = 1199901218".format(
-                internalPatientID=self.internalPatientID
-                )
-            # Capture matching NGSTests
-            self.ngstests = cursor.execute(sql).fetchall()
+        # Capture all rows returned for each participant ID
+        rows_by_participant = {}
+        participantIDs = sorted({str(case.participantID) for case in cases})
+        # SQL Server allows a maximum of 2100 parameters per query, so look up participants in batches
+        batch_size = 2048
+        for i in range(0, len(participantIDs), batch_size):
+            batch = participantIDs[i:i + batch_size]
+            # Pad the batch (by repeating the last ID) so the number of parameters is always a power of two.
+            # This keeps the number of distinct statements small, so SQL Server can reuse cached query plans.
+            batch += [batch[-1]] * ((1 << (len(batch) - 1).bit_length()) - len(batch))
+            sql = SQL_CASE_DETAILS.format(qmarks=', '.join('?' * len(batch)))
+            # Iterate over the cursor rather than using fetchall(), so rows are grouped as they're fetched without building a list first
+            for row in cursor.execute(sql, batch):
+                rows_by_participant.setdefault(str(row.Participant_ID), []).append(row)
+        for case in cases:
+            rows = rows_by_participant.get(str(case.participantID), [])
+            # Only update attributes if a single matching record is found in Probands_100k.
+            if rows and rows[0].ProbandCount == 1:
+                case.internalPatientID = rows[0].InternalPatientID
+                case.clinicianID = rows[0].Referring_Clinician
+                case.pru = rows[0].PatientTrustID
+                case.patient_status = rows[0].s_StatusOverall
+                # Capture matching NGSTests (rows without an NGSTestID are patients with no 100k NGS tests)
+                case.ngstests = [row for row in rows if row.NGSTestID is not None]
 
-    def set_result_code(self, cursor, ngstest, resultcode, status):
+    def set_result_code(self, mokaconn, ngstest, resultcode, status):
         """
         Update result code and status for a supplied NGStest.
+        The update and patient log entry are queued on the Moka connection, and written by MokaConnector.write_pending()
         
         Args:
+            mokaconn: MokaConnector object
             ngstest: An NGSTest pyodbc object (as stored in list self.ngstests)
             resultcode: Moka resultcode ID to be stored in NGStest
         """
         # Only execute if internal patient ID is known.
         if self.internalPatientID:
             # Update the result code and set Moka as Checker1
-            sql = "UPDATE NGSTest SET ResultCode = {resultcode}, StatusID = {status}, Check1ID = 1201865448, Check1Date = '{today_date}' WHERE NGSTestID = {ngstestid}".format(
-                today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p'),
-                resultcode=resultcode,
-                status=status,
-                ngstestid=ngstest.NGSTestID,
-                )
-            cursor.execute(sql)
-            # Get the human readable result code for recording in patient log
-            sql = "SELECT ResultCode FROM ResultCode WHERE ResultCodeID = {resultcode}".format(resultcode=resultcode)
-            resultcode_name = cursor.execute(sql).fetchone().ResultCode
-            # Get the human readable status for recording in patient log
-            sql = "SELECT Status FROM Status WHERE StatusID = {status}".format(status=status)
-            status_name = cursor.execute(sql).fetchone().Status
+            mokaconn.pending_updates.append((resultcode, status, mokaconn.run_date, ngstest.NGSTestID))
+            # Get the human readable result code and status for recording in patient log
+            resultcode_name = mokaconn.get_resultcode_name(resultcode)
+            status_name = mokaconn.get_status_name(status)
             # Record in patient log
-            # Use the name of the script as 'Login' and the server hostname as 'PCName'
-            sql = (
-                "INSERT INTO PatientLog (InternalPatientID, LogEntry, Date, Login, PCName) "
-                "VALUES ({internalPatientID},  'NGS: NGSTest result code updated to {resultcode_name} and status updated to {status_name} for 100k interpretation request: {intrequestID}', '{today_date}', '{username}', '{computer}');"
-                ).format(
-                    internalPatientID=self.internalPatientID,
-                    resultcode_name=resultcode_name,
-                    status_name=status_name,
-                    intrequestID=self.intrequestID,
-                    today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p'),
-                    username=os.path.basename(__file__),
-                    computer=socket.gethostname()
-                    )
-            cursor.execute(sql)
-                 
-    def get_moka_details(self, cursor):
-        """
-        Execute functions to retrieve case details from Moka
-        """
-        self.get_moka_patientIDs(cursor)
-        self.get_moka_ngstests(cursor)
-        self.get_patient_status(cursor)
+            mokaconn.pending_logs.append((
+                self.internalPatientID,
+                f"NGS: NGSTest result code updated to {resultcode_name} and status updated to {status_name} for 100k interpretation request: {self.intrequestID}",
+                mokaconn.run_date,
+                mokaconn.login,
+                mokaconn.pcname
+                ))
 
 def negnegs_one_request(input_file):
+    cases = []
     with open(input_file, 'r') as input_cases:
-        return [
-            # Capture the first two columns (participant id and interpretation request id)
-            row.strip().split('\t')[:2] for row in input_cases.readlines() 
-            # Ignore the header line
-            if not row.startswith('participant_ID')
+        # Ignore the header line
+        next(input_cases)
+        for row in input_cases:
+            # Split off the group (last column) first, so only selected rows need splitting into all their columns
+            columns, _, group = row.strip().rpartition('\t')
             # Only select cases that are negnegs with only one interpretation request
-            and row.strip().split('\t')[-1] == 'negnegs_one_request'
-            ]
+            if group == 'negnegs_one_request':
+                # Capture the first two columns (participant id and interpretation request id)
+                participantID, intrequestID = columns.split('\t', 2)[:2]
+                cases.append((participantID, intrequestID))
+    return cases
 
-def print_log(log_file, participantid, irid, pru, status, message):
-    with open(log_file, 'a') as file_obj:
-        file_obj.write(
-                "{participantid}\t{irid}\t{pru}\t{status}\t{message}\n".format(
-                participantid=participantid,
-                irid=irid,
-                pru=pru,
-                status=status,
-                message=message                
-            )
-        )
+def print_log(log_fh, participantid, irid, pru, status, message):
+    log_fh.write(f"{participantid}\t{irid}\t{pru}\t{status}\t{message}\n")
 
-def book_in_moka(cases, mokaconn, log_file):
+def book_in_moka(cases, mokaconn, log_fh):
     # Print header for output
-    print_log(log_file, 'GeLParticipantID', 'InterpretationRequestID', 'PRU', 'Status', 'Log')
+    print_log(log_fh, 'GeLParticipantID', 'InterpretationRequestID', 'PRU', 'Status', 'Log')
+    # Get case details from Moka for all cases at once
+    Case100kMoka.hydrate_all(mokaconn.cursor, cases)
+    # Cases with result code updates are only logged once the updates have been committed to Moka
+    updated_cases = []
     for case in cases:
-        case.get_moka_details(mokaconn.cursor)
         # Test that required case details are in Moka
         try:
             run_case_tests(case)
         # If tests fail, print error to log file and skip to next case
         except Exception as err:
-            print_log(log_file, case.participantID, case.intrequestID, case.pru, "ERROR", err)
+            print_log(log_fh, case.participantID, case.intrequestID, case.pru, "ERROR", err)
             continue        
         if len(case.ngstests) > 1:
             # If there are multiple 100k NGS requests for that patient, print error to log file
-            print_log(log_file, case.participantID, case.intrequestID, case.pru, "ERROR", "Multiple 100k NGStest request found for this patient")        
+            print_log(log_fh, case.participantID, case.intrequestID, case.pru, "ERROR", "Multiple 100k NGStest request found for this patient")        
         elif len(case.ngstests) < 1:
             # Cases should have already been booked in using the script found in https://github.com/moka-guys/100k_moka_booking_in
             # If case not found in Moka, error and skip to next case
-            print_log(log_file, case.participantID, case.intrequestID, case.pru, "ERROR", "No NGSTest request found. Please run 100k_moka_booking_in/100k2moka.py script first")
+            print_log(log_fh, case.participantID, case.intrequestID, case.pru, "ERROR", "No NGSTest request found. Please run 100k_moka_booking_in/100k2moka.py script first")
         # If there's already one 100k NGS request in Moka...       
         elif len(case.ngstests) == 1:
             ngstest = case.ngstests[0]
@@ -241,33 +301,42 @@ def book_in_moka(cases, mokaconn, log_file):
                 run_ngstest_tests(case, ngstest)
             # If tests fail, print error to log file and skip to next case
             except Exception as err:
-                print_log(log_file, case.participantID, case.intrequestID, case.pru, "ERROR", err)
+                print_log(log_fh, case.participantID, case.intrequestID, case.pru, "ERROR", err)
                 continue
             # If there's not currently a result code, add negneg result code and set status to Negative report:
             if not ngstest.ResultCode:
-                case.set_result_code(mokaconn.cursor, ngstest, resultcode=1189679668, status=1202218811)
-                print_log(log_file, case.participantID, case.intrequestID, case.pru, "SUCCESS", "Added result code to existing NGSTest request")
+                case.set_result_code(mokaconn, ngstest, resultcode=1189679668, status=1202218811)
+                updated_cases.append(case)
             # Otherwise all details match and no updates required, so skip
             else:
-                print_log(log_file, case.participantID, case.intrequestID, case.pru, "SKIP", "NGSTest request already exists with matching details")       
+                print_log(log_fh, case.participantID, case.intrequestID, case.pru, "SKIP", "NGSTest request already exists with matching details")       
         else:
             # Above criteria should catch everything, but if not catch here and print error
-            print_log(log_file, case.participantID, case.intrequestID, case.pru, "ERROR", "An unknow error has occurred")
+            print_log(log_fh, case.participantID, case.intrequestID, case.pru, "ERROR", "An unknow error has occurred")
+    # Write the result code updates and patient log entries to Moka in a single transaction
+    try:
+        mokaconn.write_pending()
+    # If the transaction was rolled back none of the updates were made, so log them all as errors
+    except pyodbc.Error as err:
+        for case in updated_cases:
+            print_log(log_fh, case.participantID, case.intrequestID, case.pru, "ERROR", f"Failed to add result code to existing NGSTest request: {err}")
+        raise
+    for case in updated_cases:
+        print_log(log_fh, case.participantID, case.intrequestID, case.pru, "SUCCESS", "Added result code to existing NGSTest request")
 
 def main():
     # Get command line arguments
     args = process_arguments()
     # Raise error if file doesn't start with expected header row
     with open(args.input_file, 'r') as file_to_check:
-        if not file_to_check.read().startswith('participant_ID\tCIP_ID\tassembly\tflags\tgroup'):
+        if not file_to_check.readline().startswith('participant_ID\tCIP_ID\tassembly\tflags\tgroup'):
             sys.exit('Input file does not contain expected header row. Exiting')
     # Create a list of 100k case objects for negneg cases with only one interpretation request
     negnegs = negnegs_one_request(args.input_file)
     cases = [Case100kMoka(participantID, intrequestID) for participantID, intrequestID in negnegs]
-    # Create a Moka connection
-    mokaconn = MokaConnector()
-    # Book cases into moka
-    book_in_moka(cases, mokaconn, args.output_file)
+    # Create a Moka connection (closed when the block exits) and book cases into moka, keeping the log file open for the whole run
+    with MokaConnector() as mokaconn, open(args.output_file, 'a', buffering=1 << 16) as log_fh:
+        book_in_moka(cases, mokaconn, log_fh)
 
 
 if __name__ == '__main__':